@@ -1,19 +1,78 @@
+import os
+import json
 import pandas as pd
 from openai import OpenAI
 import ast
 
-# 1. Cargar CSV
-df = pd.read_csv("tiendas_detalle.csv")
+try:
+    from pyarrow import csv as pacsv
+    import pyarrow.compute as pc
+except ImportError:
+    pacsv = None
+    pc = None
+
+# 1. Cargar CSV (parser multi-hilo de pyarrow si está instalado)
+tabla_arrow = None
+if pacsv is not None:
+    tabla_arrow = pacsv.read_csv("tiendas_detalle.csv")
+    df = tabla_arrow.to_pandas()
+else:
+    df = pd.read_csv("tiendas_detalle.csv")
 
 # 2. Crear un resumen del DataFrame para darle contexto al LLM
 #    (evitamos pasar todas las filas, solo columnas y valores únicos)
-schema_info = []
-for col in df.columns:
-    unique_vals = df[col].dropna().unique()
-    unique_preview = unique_vals[:10]  # primeros 10 valores
-    schema_info.append(f"{col} ({df[col].dtype}): valores ejemplo: {list(unique_preview)}")
 
-schema_text = "\n".join(schema_info)
+def first_k_unique(valores, k=10):
+    """Primeros k valores distintos con corte temprano (sin hashear toda la columna)."""
+    vistos = set()
+    muestra = []
+    for v in valores:
+        if v == v and v not in vistos:  # v == v descarta NaN
+            vistos.add(v)
+            muestra.append(v)
+            if len(muestra) == k:
+                break
+    return muestra
+
+
+# Por debajo de este tamaño el kernel hash de Arrow (SIMD, C++) gana;
+# por encima conviene el muestreo con corte temprano
+_UMBRAL_UNIQUE_COMPLETO = 100_000
+
+
+def construir_schema_text(df, csv_path, tabla=None, cache_path="schema_cache.json"):
+    """Construye el resumen de columnas, cacheado en disco por mtime+tamaño del CSV."""
+    stat = os.stat(csv_path)
+    clave = f"{stat.st_mtime_ns}:{stat.st_size}"
+
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                cache = json.load(f)
+            if cache.get("clave") == clave:
+                return cache["schema_text"]
+        except (ValueError, KeyError):
+            pass  # cache corrupto: se regenera
+
+    usar_arrow = tabla is not None and pc is not None and len(df) <= _UMBRAL_UNIQUE_COMPLETO
+
+    schema_info = []
+    dtypes = df.dtypes  # una sola consulta de tipos, no df[col].dtype por columna
+    for col, serie in df.items():
+        if usar_arrow:
+            unicos = pc.unique(pc.drop_null(tabla.column(col)))
+            unique_preview = unicos.slice(0, 10).to_pylist()
+        else:
+            unique_preview = first_k_unique(serie.to_numpy())
+        schema_info.append(f"{col} ({dtypes[col]}): valores ejemplo: {unique_preview}")
+
+    schema_text = "\n".join(schema_info)
+    with open(cache_path, "w", encoding="utf-8") as f:
+        json.dump({"clave": clave, "schema_text": schema_text}, f, ensure_ascii=False)
+    return schema_text
+
+
+schema_text = construir_schema_text(df, "tiendas_detalle.csv", tabla=tabla_arrow)
 
 # 3. Inicializar cliente OpenAI
 client = OpenAI(api_key="TU_API_KEY")
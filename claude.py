@@ -2,16 +2,85 @@ import openai
 import pandas as pd
 import json
 import re
+from collections import deque
 from typing import Optional, Dict, Any, List
 from datetime import datetime
 import numpy as np
 
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    from pyarrow import csv as pacsv
+except ImportError:
+    pacsv = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Literales prohibidos en el código generado. Se escanean sobre la forma
+# canónica (minúsculas, espacios colapsados, sin espacios junto a la
+# puntuación), así "inplace = True" o "exec (" no esquivan el filtro y la
+# política es la misma con o sin ahocorasick instalado
+_PALABRAS_PROHIBIDAS = ('import os', 'import sys', '__import__', 'exec(',
+                        'eval(', 'open(', 'file(', 'input(', 'raw_input',
+                        'inplace=true', '.update(', '.insert(', '.pop(')
+
+_RE_ESPACIOS = re.compile(r'\s+')
+_RE_PUNTUACION = re.compile(r' ?([(=.]) ?')
+
+
+def _canonizar_codigo(codigo):
+    """Forma canónica del código para el escaneo de seguridad."""
+    plano = _RE_ESPACIOS.sub(' ', codigo.lower())
+    return _RE_PUNTUACION.sub(r'\1', plano)
+
+
+if ahocorasick is not None:
+    # Autómata multi-patrón: una sola pasada DFA sobre el código,
+    # escala a cientos de patrones sin costo extra por patrón
+    _AUTOMATA_PROHIBIDO = ahocorasick.Automaton()
+    for _palabra in _PALABRAS_PROHIBIDAS:
+        _AUTOMATA_PROHIBIDO.add_word(_palabra, _palabra)
+    _AUTOMATA_PROHIBIDO.make_automaton()
+else:
+    _AUTOMATA_PROHIBIDO = None
+
+
+def _json_loads(texto):
+    """Parsea JSON con orjson si está instalado (codec en Rust, 3-10x más rápido)."""
+    return orjson.loads(texto) if orjson is not None else json.loads(texto)
+
+
+def leer_csv(csv_path: str) -> pd.DataFrame:
+    """
+    Lee un CSV con el parser multi-hilo de pyarrow si está disponible;
+    cae a pd.read_csv en caso contrario.
+    """
+    if pacsv is not None:
+        return pacsv.read_csv(csv_path).to_pandas()
+    return pd.read_csv(csv_path)
+
 class ChatbotCSV:
     """
     Chatbot para análisis de archivos CSV usando OpenAI GPT-4
     con function calling para ejecución segura de código pandas.
     """
-    
+
+    # Un solo escaneo lineal sobre la forma canónica del código; la
+    # alternación se genera desde la misma lista que alimenta el autómata
+    # para que ambas rutas bloqueen exactamente los mismos patrones
+    _CODIGO_PROHIBIDO = re.compile('|'.join(re.escape(p) for p in _PALABRAS_PROHIBIDAS))
+
     def __init__(self, csv_path: str, api_key: str, model: str = "gpt-4-turbo-preview"):
         """
         Inicializa el chatbot con un archivo CSV.
@@ -21,14 +90,62 @@ class ChatbotCSV:
             api_key: API key de OpenAI
             model: Modelo de OpenAI a usar
         """
-        openai.api_key = api_key
+        # Un solo cliente persistente: reutiliza la conexión TLS entre
+        # llamadas en vez del endpoint global deprecado
+        self.client = openai.OpenAI(api_key=api_key)
         self.model = model
-        self.df = pd.read_csv(csv_path)
+        self.df = leer_csv(csv_path)
+        # Los arrays subyacentes quedan de solo lectura: el dataframe se
+        # comparte con el código del LLM sin copiarlo, y la lista de
+        # prohibidos no puede enumerar todos los mutadores (df['x'].values
+        # .fill(0), np.put(...), etc.) — cualquier escritura in-place
+        # levanta ValueError en vez de corromper las respuestas siguientes
+        for _bloque in self.df._mgr.blocks:
+            if hasattr(_bloque.values, 'setflags'):
+                _bloque.values.setflags(write=False)
         self.csv_path = csv_path
-        self.historial = []
+        # Historial acotado: los mensajes viejos se descartan solos
+        self.historial = deque(maxlen=20)
+
+        # Cache de expresiones compiladas: evita re-parsear el mismo código
+        # pandas en preguntas repetidas (clave = texto del código)
+        self._cache_codigo = {}
+        self._cache_codigo_max = 128
+
+        # Cache de respuestas por pregunta exacta: una pregunta repetida
+        # vuelve en milisegundos sin tocar la API
+        self._cache_respuestas = {}
+
+        # Salidas formateadas de describe()/head(), calculadas a demanda
+        # una sola vez (el dataframe no cambia tras el init)
+        self._describe_str = None
+        self._muestra_str = None
+
+        # Motor SQL opcional: si duckdb está instalado, registramos el
+        # dataframe para ejecutar consultas SELECT de forma vectorizada
+        if duckdb is not None:
+            self._duckdb = duckdb.connect(':memory:')
+            self._duckdb.register('df', self.df)
+        else:
+            self._duckdb = None
         
         # Generar metadata del dataset
         self.metadata = self._generar_metadata()
+
+        # El prompt del sistema depende solo de la metadata (inmutable tras
+        # el init), así que se construye una única vez
+        self._prompt_sistema = self._crear_prompt_sistema()
+
+        # Lista de mensajes persistente para la API: se agrega al final en
+        # cada turno en vez de reconstruir el prefijo completo por llamada
+        self._mensajes = [{"role": "system", "content": self._prompt_sistema}]
+
+        # Columnas de texto pre-factorizadas a códigos int para que las
+        # agregaciones por grupo no paguen hashing de strings por consulta
+        self._codigos_grupo = {
+            col: pd.factorize(self.df[col])
+            for col in self.metadata['columnas_texto']
+        }
         
         # Definir las funciones disponibles para OpenAI
         self.functions = [
@@ -50,6 +167,55 @@ class ChatbotCSV:
                     "required": ["codigo", "explicacion"]
                 }
             },
+            {
+                "name": "ejecutar_agregacion",
+                "description": "Atajo rápido para agregaciones comunes (suma, promedio, top-k) sin generar código pandas",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "operacion": {
+                            "type": "string",
+                            "enum": ["suma", "promedio", "top"],
+                            "description": "Agregación a aplicar sobre la columna numérica"
+                        },
+                        "columna": {
+                            "type": "string",
+                            "description": "Columna numérica a agregar"
+                        },
+                        "agrupar_por": {
+                            "type": "string",
+                            "description": "Columna de texto por la que agrupar (opcional)"
+                        },
+                        "filtro_col": {
+                            "type": "string",
+                            "description": "Columna por la que filtrar (opcional)"
+                        },
+                        "filtro_val": {
+                            "type": "string",
+                            "description": "Valor exacto que debe tener filtro_col (opcional)"
+                        },
+                        "k": {
+                            "type": "integer",
+                            "description": "Cantidad de filas para la operación 'top' (default 5)"
+                        }
+                    },
+                    "required": ["operacion", "columna"]
+                }
+            },
+            {
+                "name": "ejecutar_sql",
+                "description": "Ejecuta una consulta SQL de solo lectura sobre la tabla 'df' con DuckDB. Preferida para filtros, agrupaciones y joins: es vectorizada y no ejecuta Python arbitrario",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "sql": {
+                            "type": "string",
+                            "description": "Consulta SELECT sobre la tabla 'df'"
+                        }
+                    },
+                    "required": ["sql"]
+                }
+            },
             {
                 "name": "obtener_info_dataset",
                 "description": "Obtiene información general sobre el dataset",
@@ -66,16 +232,34 @@ class ChatbotCSV:
                 }
             }
         ]
+
+        # Sin duckdb no se ofrece la función SQL al modelo
+        if self._duckdb is None:
+            self.functions = [f for f in self.functions if f["name"] != "ejecutar_sql"]
     
     def _generar_metadata(self) -> Dict[str, Any]:
-        """Genera metadata del dataset para contexto."""
+        """Genera metadata del dataset para contexto en una sola pasada."""
+        # Una sola pasada sobre las columnas: tipos, nulos y clasificación
+        # numérica/texto juntos, sin select_dtypes ni isnull().sum() separados
+        tipos_datos = {}
+        valores_nulos = self.df.isna().sum().to_dict()
+        columnas_numericas = []
+        columnas_texto = []
+
+        for col, dtype in self.df.dtypes.items():
+            tipos_datos[col] = str(dtype)
+            if pd.api.types.is_numeric_dtype(dtype):
+                columnas_numericas.append(col)
+            elif dtype == object:
+                columnas_texto.append(col)
+
         return {
             "columnas": self.df.columns.tolist(),
             "filas": len(self.df),
-            "tipos_datos": self.df.dtypes.astype(str).to_dict(),
-            "valores_nulos": self.df.isnull().sum().to_dict(),
-            "columnas_numericas": self.df.select_dtypes(include=[np.number]).columns.tolist(),
-            "columnas_texto": self.df.select_dtypes(include=['object']).columns.tolist()
+            "tipos_datos": tipos_datos,
+            "valores_nulos": valores_nulos,
+            "columnas_numericas": columnas_numericas,
+            "columnas_texto": columnas_texto
         }
     
     def _ejecutar_codigo_seguro(self, codigo: str) -> Dict[str, Any]:
@@ -91,59 +275,191 @@ class ChatbotCSV:
         # Limpieza básica del código
         codigo = codigo.strip()
         
-        # Validaciones de seguridad básicas
-        palabras_prohibidas = ['import os', 'import sys', '__import__', 'exec', 
-                               'eval', 'open(', 'file(', 'input(', 'raw_input']
-        
-        for palabra in palabras_prohibidas:
-            if palabra in codigo.lower():
+        # Validaciones de seguridad básicas, sobre la forma canónica para
+        # que el espaciado no cambie qué se bloquea
+        canonico = _canonizar_codigo(codigo)
+        if _AUTOMATA_PROHIBIDO is not None:
+            for _, palabra in _AUTOMATA_PROHIBIDO.iter(canonico):
                 return {
                     "exito": False,
                     "error": f"Código contiene operación no permitida: {palabra}",
                     "resultado": None
                 }
+        else:
+            prohibido = self._CODIGO_PROHIBIDO.search(canonico)
+            if prohibido:
+                return {
+                    "exito": False,
+                    "error": f"Código contiene operación no permitida: {prohibido.group(0)}",
+                    "resultado": None
+                }
         
         # Namespace limitado para ejecución
+        # Se pasa el dataframe directo: eval() no admite sentencias de
+        # asignación y las mutaciones in-place quedan bloqueadas arriba,
+        # así evitamos duplicar todo el dataframe en cada consulta
         namespace = {
-            'df': self.df.copy(),  # Usar copia para evitar modificaciones
+            'df': self.df,
             'pd': pd,
             'np': np,
             'datetime': datetime
         }
         
         try:
-            # Ejecutar el código
-            resultado = eval(codigo, {"__builtins__": {}}, namespace)
-            
-            # Formatear resultado según tipo
-            if isinstance(resultado, pd.DataFrame):
-                if len(resultado) > 100:
-                    resultado_str = f"DataFrame con {len(resultado)} filas y {len(resultado.columns)} columnas\n"
-                    resultado_str += f"Primeras 10 filas:\n{resultado.head(10).to_string()}"
-                else:
-                    resultado_str = resultado.to_string()
-            elif isinstance(resultado, pd.Series):
-                if len(resultado) > 50:
-                    resultado_str = f"Series con {len(resultado)} elementos\n"
-                    resultado_str += f"Primeros 10 elementos:\n{resultado.head(10).to_string()}"
-                else:
-                    resultado_str = resultado.to_string()
+            # Si el código es SQL y duckdb está disponible, usar el motor
+            # vectorizado en lugar del intérprete de Python
+            if self._duckdb is not None and codigo.lstrip().lower().startswith(('select', 'with')):
+                resultado = self._duckdb.execute(codigo).df()
             else:
-                resultado_str = str(resultado)
+                # Compilar una sola vez por expresión y reutilizar el code object
+                compilado = self._cache_codigo.get(codigo)
+                if compilado is None:
+                    compilado = compile(codigo, '<consulta>', 'eval')
+                    if len(self._cache_codigo) >= self._cache_codigo_max:
+                        self._cache_codigo.pop(next(iter(self._cache_codigo)))
+                    self._cache_codigo[codigo] = compilado
+
+                # Ejecutar el código
+                resultado = eval(compilado, {"__builtins__": {}}, namespace)
             
             return {
                 "exito": True,
-                "resultado": resultado_str,
+                "resultado": self._formatear_resultado(resultado),
                 "tipo_resultado": type(resultado).__name__
             }
-            
+
         except Exception as e:
             return {
                 "exito": False,
                 "error": str(e),
                 "resultado": None
             }
+
+    @staticmethod
+    def _formatear_resultado(resultado) -> str:
+        """Formatea un resultado según su tipo, acotando salidas grandes."""
+        if isinstance(resultado, pd.DataFrame):
+            if len(resultado) > 100:
+                return (f"DataFrame con {len(resultado)} filas y {len(resultado.columns)} columnas\n"
+                        f"Primeras 10 filas:\n{resultado.head(10).to_string()}")
+            return resultado.to_string()
+        if isinstance(resultado, pd.Series):
+            if len(resultado) > 50:
+                return (f"Series con {len(resultado)} elementos\n"
+                        f"Primeros 10 elementos:\n{resultado.head(10).to_string()}")
+            return resultado.to_string()
+        return str(resultado)
+
+    def _ejecutar_sql(self, sql: str) -> Dict[str, Any]:
+        """
+        Ejecuta una consulta SQL de solo lectura sobre la tabla 'df'
+        registrada en DuckDB (lectura zero-copy del dataframe).
+
+        Args:
+            sql: Consulta SELECT a ejecutar
+
+        Returns:
+            Dict con resultado y estado de ejecución
+        """
+        if self._duckdb is None:
+            return {"exito": False, "error": "duckdb no está instalado", "resultado": None}
+
+        if not sql.lstrip().lower().startswith(('select', 'with')):
+            return {"exito": False, "error": "Solo se permiten consultas SELECT", "resultado": None}
+
+        try:
+            resultado = self._duckdb.execute(sql).df()
+            return {
+                "exito": True,
+                "resultado": self._formatear_resultado(resultado),
+                "tipo_resultado": type(resultado).__name__
+            }
+        except Exception as e:
+            return {"exito": False, "error": str(e), "resultado": None}
     
+    def _ejecutar_agregacion(self, operacion: str, columna: str,
+                             agrupar_por: Optional[str] = None,
+                             filtro_col: Optional[str] = None,
+                             filtro_val: Optional[str] = None,
+                             k: int = 5) -> Dict[str, Any]:
+        """
+        Resuelve las agregaciones más frecuentes con kernels numpy puros
+        (bincount / argpartition) sobre columnas pre-factorizadas,
+        evitando el groupby de pandas sobre strings.
+
+        Args:
+            operacion: 'suma', 'promedio' o 'top'
+            columna: Columna numérica a agregar
+            agrupar_por: Columna de texto por la que agrupar (opcional)
+            filtro_col: Columna por la que filtrar (opcional)
+            filtro_val: Valor exacto del filtro (opcional)
+            k: Cantidad de filas para 'top'
+
+        Returns:
+            Dict con resultado y estado de ejecución
+        """
+        if columna not in self.metadata['columnas_numericas']:
+            return {"exito": False, "error": f"Columna no numérica: {columna}", "resultado": None}
+
+        valores = self.df[columna].to_numpy()
+        indices = None  # índices de fila activos tras el filtro
+
+        try:
+            if filtro_col is not None:
+                if filtro_col in self._codigos_grupo:
+                    codigos_filtro, unicos = self._codigos_grupo[filtro_col]
+                    coincidencias = np.flatnonzero(np.asarray(unicos) == filtro_val)
+                    if coincidencias.size == 0:
+                        return {"exito": False, "error": f"Valor desconocido para {filtro_col}: {filtro_val}", "resultado": None}
+                    mascara = codigos_filtro == coincidencias[0]
+                else:
+                    mascara = self.df[filtro_col].to_numpy() == filtro_val
+                indices = np.flatnonzero(mascara)
+                valores = valores[indices]
+
+            if operacion == "top":
+                if valores.size == 0:
+                    return {"exito": False, "error": "No hay filas tras aplicar el filtro", "resultado": None}
+                k = min(int(k), valores.size)
+                parciales = np.argpartition(valores, -k)[-k:]
+                orden = parciales[np.argsort(valores[parciales])[::-1]]
+                filas = indices[orden] if indices is not None else orden
+                resultado = self.df.iloc[filas]
+
+            elif agrupar_por is not None:
+                if agrupar_por not in self._codigos_grupo:
+                    return {"exito": False, "error": f"Columna de agrupación no reconocida: {agrupar_por}", "resultado": None}
+                codigos, unicos = self._codigos_grupo[agrupar_por]
+                if indices is not None:
+                    codigos = codigos[indices]
+                validos = codigos >= 0  # descartar NaN factorizados como -1
+                codigos_v = codigos[validos]
+                valores_v = valores[validos]
+                sumas = np.bincount(codigos_v, weights=valores_v, minlength=len(unicos))
+                if operacion == "promedio":
+                    cuentas = np.bincount(codigos_v, minlength=len(unicos))
+                    agregado = sumas / np.maximum(cuentas, 1)
+                else:
+                    agregado = sumas
+                resultado = pd.Series(agregado, index=unicos, name=columna)
+
+            elif operacion == "suma":
+                resultado = float(valores.sum())
+            elif operacion == "promedio":
+                resultado = float(valores.mean()) if valores.size else float('nan')
+            else:
+                return {"exito": False, "error": f"Operación no reconocida: {operacion}", "resultado": None}
+
+            if isinstance(resultado, (pd.DataFrame, pd.Series)):
+                resultado_str = resultado.to_string()
+            else:
+                resultado_str = str(resultado)
+
+            return {"exito": True, "resultado": resultado_str, "tipo_resultado": type(resultado).__name__}
+
+        except Exception as e:
+            return {"exito": False, "error": str(e), "resultado": None}
+
     def obtener_info_dataset(self, tipo_info: str) -> str:
         """
         Obtiene información específica del dataset.
@@ -162,10 +478,14 @@ class ChatbotCSV:
             return f"Tipos de datos:\n{tipos_str}"
         
         elif tipo_info == "estadisticas":
-            return self.df.describe().to_string()
-        
+            if self._describe_str is None:
+                self._describe_str = self.df.describe().to_string()
+            return self._describe_str
+
         elif tipo_info == "muestra":
-            return f"Primeras 5 filas del dataset:\n{self.df.head().to_string()}"
+            if self._muestra_str is None:
+                self._muestra_str = f"Primeras 5 filas del dataset:\n{self.df.head().to_string()}"
+            return self._muestra_str
         
         elif tipo_info == "dimensiones":
             return f"El dataset tiene {self.metadata['filas']} filas y {len(self.metadata['columnas'])} columnas"
@@ -175,6 +495,10 @@ class ChatbotCSV:
     
     def _crear_prompt_sistema(self) -> str:
         """Crea el prompt del sistema con contexto del dataset."""
+        nota_sql = ""
+        if self._duckdb is not None:
+            nota_sql = "\n7. Prefiere la función 'ejecutar_sql' (tabla 'df') para filtros, agrupaciones y joins"
+
         return f"""Eres un analista de datos experto que ayuda a analizar un dataset CSV.
         
 INFORMACIÓN DEL DATASET:
@@ -190,7 +514,7 @@ INSTRUCCIONES:
 3. Siempre explica qué estás haciendo antes de ejecutar código
 4. Si hay errores, intenta corregirlos y ejecutar de nuevo
 5. Proporciona respuestas claras y concisas
-6. Para consultas complejas, divide el problema en pasos
+6. Para consultas complejas, divide el problema en pasos{nota_sql}
 
 IMPORTANTE: 
 - NO modifiques el dataframe original (usa .copy() si necesitas modificar)
@@ -208,34 +532,48 @@ IMPORTANTE:
         Returns:
             Respuesta generada por el modelo
         """
-        # Preparar mensajes
-        mensajes = [
-            {"role": "system", "content": self._crear_prompt_sistema()}
-        ]
-        
-        # Agregar historial si corresponde
-        if usar_historial and self.historial:
-            mensajes.extend(self.historial[-10:])  # Últimos 10 mensajes
-        
+        # Atajo: pregunta idéntica ya respondida en esta sesión. Solo vale
+        # para preguntas sin contexto previo: con historial no vacío, un
+        # follow-up ("¿y el promedio?") cacheado en otra conversación se
+        # reproduciría fuera de contexto
+        clave_cache = pregunta.strip().lower()
+        con_contexto = usar_historial and len(self._mensajes) > 1
+        if not con_contexto and clave_cache in self._cache_respuestas:
+            respuesta_cacheada = self._cache_respuestas[clave_cache]
+            if usar_historial:
+                # Un hit no debe desaparecer de la conversación: registrar
+                # el turno igual que en el camino normal
+                self._mensajes.append({"role": "user", "content": pregunta})
+                self._mensajes.append({"role": "assistant", "content": respuesta_cacheada})
+                self.historial.append({"role": "user", "content": pregunta})
+                self.historial.append({"role": "assistant", "content": respuesta_cacheada})
+            return respuesta_cacheada
+
+        # Lista persistente (con historial) o mínima para preguntas sueltas
+        if usar_historial:
+            mensajes = self._mensajes
+        else:
+            mensajes = [{"role": "system", "content": self._prompt_sistema}]
+
         # Agregar pregunta actual
         mensajes.append({"role": "user", "content": pregunta})
         
         try:
             # Llamada inicial a OpenAI
-            response = openai.ChatCompletion.create(
+            response = self.client.chat.completions.create(
                 model=self.model,
                 messages=mensajes,
                 functions=self.functions,
                 function_call="auto",
                 temperature=0.1  # Baja temperatura para respuestas más consistentes
             )
-            
+
             message = response.choices[0].message
-            
+
             # Si el modelo quiere ejecutar una función
-            if message.get("function_call"):
-                function_name = message["function_call"]["name"]
-                function_args = json.loads(message["function_call"]["arguments"])
+            if message.function_call:
+                function_name = message.function_call.name
+                function_args = _json_loads(message.function_call.arguments)
                 
                 # Ejecutar la función correspondiente
                 if function_name == "ejecutar_consulta_pandas":
@@ -250,42 +588,79 @@ IMPORTANTE:
                     # Agregar explicación del código
                     function_response = f"Explicación: {function_args['explicacion']}\n\n{function_response}"
                 
+                elif function_name == "ejecutar_sql":
+                    resultado = self._ejecutar_sql(function_args["sql"])
+
+                    if resultado["exito"]:
+                        function_response = f"Resultado exitoso:\n{resultado['resultado']}"
+                    else:
+                        function_response = f"Error al ejecutar SQL: {resultado['error']}"
+
+                elif function_name == "ejecutar_agregacion":
+                    resultado = self._ejecutar_agregacion(**function_args)
+
+                    if resultado["exito"]:
+                        function_response = f"Resultado exitoso:\n{resultado['resultado']}"
+                    else:
+                        function_response = f"Error al ejecutar agregación: {resultado['error']}"
+
                 elif function_name == "obtener_info_dataset":
                     function_response = self.obtener_info_dataset(function_args["tipo_info"])
                 
                 # Obtener respuesta final del modelo
-                mensajes.append(message)
+                mensajes.append(message.model_dump(exclude_none=True))
                 mensajes.append({
                     "role": "function",
                     "name": function_name,
                     "content": function_response
                 })
-                
-                final_response = openai.ChatCompletion.create(
+
+                final_response = self.client.chat.completions.create(
                     model=self.model,
                     messages=mensajes,
                     temperature=0.1
                 )
-                
-                respuesta_final = final_response.choices[0].message["content"]
-                
+
+                respuesta_final = final_response.choices[0].message.content
+
             else:
                 # Respuesta directa sin función
-                respuesta_final = message["content"]
+                respuesta_final = message.content
             
             # Actualizar historial
             if usar_historial:
+                mensajes.append({"role": "assistant", "content": respuesta_final})
+                # Recortar in-place: conservar el prompt del sistema y
+                # descartar turnos completos (un turno con function calling
+                # ocupa 4 mensajes, no 2: cortar en pares dejaría un
+                # "function" huérfano y separaría la llamada de su resultado)
+                while len(self._mensajes) > 21:
+                    fin_turno = next(
+                        (j for j in range(2, len(self._mensajes))
+                         if self._mensajes[j].get("role") == "user"),
+                        len(self._mensajes),
+                    )
+                    del self._mensajes[1:fin_turno]
+
                 self.historial.append({"role": "user", "content": pregunta})
                 self.historial.append({"role": "assistant", "content": respuesta_final})
-            
+
+            # Cachear solo respuestas generadas sin contexto: las que
+            # dependen del historial no son reutilizables
+            if not con_contexto:
+                self._cache_respuestas[clave_cache] = respuesta_final
             return respuesta_final
-            
+
         except Exception as e:
+            if usar_historial and mensajes and mensajes[-1].get("role") == "user":
+                mensajes.pop()  # no dejar una pregunta sin respuesta en el prefijo
             return f"Error al procesar la pregunta: {str(e)}"
     
     def limpiar_historial(self):
-        """Limpia el historial de conversación."""
-        self.historial = []
+        """Limpia el historial de conversación y el cache de respuestas."""
+        self.historial.clear()
+        self._cache_respuestas.clear()
+        del self._mensajes[1:]  # conservar solo el prompt del sistema
         print("Historial limpiado.")
     
     def guardar_sesion(self, archivo: str):
@@ -298,12 +673,16 @@ IMPORTANTE:
         sesion = {
             "timestamp": datetime.now().isoformat(),
             "csv_path": self.csv_path,
-            "historial": self.historial,
+            "historial": list(self.historial),
             "metadata": self.metadata
         }
         
-        with open(archivo, 'w', encoding='utf-8') as f:
-            json.dump(sesion, f, ensure_ascii=False, indent=2)
+        if orjson is not None:
+            with open(archivo, 'wb') as f:
+                f.write(orjson.dumps(sesion, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+        else:
+            with open(archivo, 'w', encoding='utf-8') as f:
+                json.dump(sesion, f, ensure_ascii=False, indent=2)
         
         print(f"Sesión guardada en {archivo}")
     
@@ -317,7 +696,8 @@ IMPORTANTE:
         with open(archivo, 'r', encoding='utf-8') as f:
             sesion = json.load(f)
         
-        self.historial = sesion["historial"]
+        self.historial = deque(sesion["historial"], maxlen=20)
+        self._mensajes = [{"role": "system", "content": self._prompt_sistema}] + list(self.historial)
         print(f"Sesión cargada: {len(self.historial)} mensajes en historial")
 
 
@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 """
-Flask Backend for Gatorade AB Testing Dashboard
+Quart (async Flask) Backend for Gatorade AB Testing Dashboard
 Integrates the advanced chatbot with session memory and embeddings
 """
 
-from flask import Flask, request, jsonify, send_from_directory
-from flask_cors import CORS
-import asyncio
+from quart import Quart, request, jsonify, send_from_directory
+from quart_cors import cors
+import orjson
 import os
 import sys
 import logging
@@ -21,14 +21,22 @@ from modern_chatbot import ModernDataChatbot
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Flask app
-app = Flask(__name__, static_folder='../frontend/dist', static_url_path='')
-CORS(app, origins=["http://localhost:3000", "http://localhost:5173"])  # Allow React dev server
+# Initialize Quart app (ASGI, Flask-compatible API)
+app = Quart(__name__, static_folder='../frontend/dist', static_url_path='')
+app = cors(app, allow_origin=["http://localhost:3000", "http://localhost:5173"])  # Allow React dev server
 
 # Global chatbot instance
 chatbot = None
 active_sessions = {}
 
+def json_response(payload, status=200):
+    """Serialize with orjson (Rust codec, handles numpy scalars natively)"""
+    return app.response_class(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype="application/json"
+    )
+
 def initialize_chatbot():
     """Initialize the chatbot with data files"""
     global chatbot
@@ -44,7 +52,7 @@ def initialize_chatbot():
         return False
 
 @app.route('/api/health')
-def health_check():
+async def health_check():
     """Health check endpoint"""
     return jsonify({
         "status": "healthy",
@@ -53,10 +61,10 @@ def health_check():
     })
 
 @app.route('/api/chat/start', methods=['POST'])
-def start_chat_session():
+async def start_chat_session():
     """Start a new chat session"""
     try:
-        data = request.get_json()
+        data = await request.get_json()
         user_email = data.get('userEmail', 'anonymous')
         
         # Generate new session ID
@@ -82,18 +90,18 @@ def start_chat_session():
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/chat/message', methods=['POST'])
-def chat_message():
+async def chat_message():
     """Process a chat message"""
     try:
-        data = request.get_json()
+        data = await request.get_json()
         session_id = data.get('session_id')
         message = data.get('message', '').strip()
         
         if not session_id or not message:
-            return jsonify({"success": False, "error": "Missing session_id or message"}), 400
-        
+            return json_response({"success": False, "error": "Missing session_id or message"}, status=400)
+
         if chatbot is None:
-            return jsonify({"success": False, "error": "Chatbot not initialized"}), 500
+            return json_response({"success": False, "error": "Chatbot not initialized"}, status=500)
         
         # Update session activity
         if session_id in active_sessions:
@@ -101,13 +109,8 @@ def chat_message():
         
         logger.info(f"💬 Processing message in session {session_id}: {message[:50]}...")
         
-        # Process message with our advanced chatbot (run async in sync context)
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            response = loop.run_until_complete(chatbot.ask(message, session_id=session_id))
-        finally:
-            loop.close()
+        # Process message with our advanced chatbot, awaited on the server loop
+        response = await chatbot.ask(message, session_id=session_id)
         
         # Format response for frontend
         chat_response = {
@@ -126,14 +129,14 @@ def chat_message():
         }
         
         logger.info(f"✅ Response generated for {session_id} in {response.get('execution_time', 0):.2f}s")
-        return jsonify(chat_response)
-    
+        return json_response(chat_response)
+
     except Exception as e:
         logger.error(f"❌ Error processing chat message: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+        return json_response({"success": False, "error": str(e)}, status=500)
 
 @app.route('/api/chat/history/<session_id>')
-def get_chat_history(session_id):
+async def get_chat_history(session_id):
     """Get chat history for a session"""
     try:
         if chatbot is None:
@@ -152,7 +155,7 @@ def get_chat_history(session_id):
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/analytics/sessions')
-def get_session_analytics():
+async def get_session_analytics():
     """Get analytics about chat sessions"""
     try:
         if chatbot is None:
@@ -176,7 +179,7 @@ def get_session_analytics():
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/data/summary')
-def get_data_summary():
+async def get_data_summary():
     """Get summary of available data for the frontend"""
     try:
         if chatbot is None:
@@ -203,34 +206,29 @@ def get_data_summary():
 
 # Serve React app for production
 @app.route('/')
-def serve_react_app():
+async def serve_react_app():
     """Serve the React frontend"""
-    return send_from_directory(app.static_folder, 'index.html')
+    return await send_from_directory(app.static_folder, 'index.html')
 
 @app.route('/<path:path>')
-def serve_react_assets(path):
+async def serve_react_assets(path):
     """Serve React static assets"""
-    return send_from_directory(app.static_folder, path)
+    return await send_from_directory(app.static_folder, path)
 
 @app.errorhandler(404)
-def not_found(error):
+async def not_found(error):
     """Handle 404 errors by serving React app (for client-side routing)"""
-    return send_from_directory(app.static_folder, 'index.html')
+    return await send_from_directory(app.static_folder, 'index.html')
 
 if __name__ == '__main__':
     # Initialize chatbot on startup
-    logger.info("🚀 Starting Flask backend for Gatorade AB Testing Dashboard...")
-    
+    logger.info("🚀 Starting ASGI backend for Gatorade AB Testing Dashboard...")
+
     if initialize_chatbot():
-        logger.info("🤖 Chatbot ready! Starting Flask server...")
-        
-        # Run in development mode
-        app.run(
-            host='0.0.0.0',
-            port=5000,
-            debug=True,
-            threaded=True
-        )
+        logger.info("🤖 Chatbot ready! Starting uvicorn server...")
+
+        import uvicorn
+        uvicorn.run(app, host='0.0.0.0', port=5000)
     else:
         logger.error("❌ Failed to initialize chatbot. Exiting...")
         sys.exit(1)
\ No newline at end of file